@@ -10,111 +10,202 @@
 - 任务状态监控
 - 结果文件管理
 
+启动方式：
+    python app.py
+    或 uvicorn app:app --host 0.0.0.0 --port 5000 --loop uvloop --http httptools
+
 Author: Samueli924
 Date: 2024-02
 License: MIT
 Version: 1.0.0
 """
 
-from flask import Flask, request, jsonify
-from src.llm import TranslationModel
+from quart import Quart, Response, request
 from src.funcs import (
     read_srt_file, 
     generate_translated_srt, 
-    format_translation_prompt_with_context
+    format_translation_prompt_with_context,
+    parse_batch_translation_result
 )
 from src.logging import LOGGER
 import os
-from dotenv import load_dotenv
 import asyncio
 from datetime import datetime
+from dataclasses import dataclass, field
+from functools import lru_cache
+import orjson
+import shutil
 import uuid
-from typing import Dict, Optional
+from typing import TYPE_CHECKING, Dict, Optional, Set
+
+if TYPE_CHECKING:
+    from src.llm import TranslationModel
 
-app = Flask(__name__)
+app = Quart(__name__)
+# Quart默认限制请求体16MB并设有读取超时，显式放宽以支持上传大字幕文件
+app.config["MAX_CONTENT_LENGTH"] = 256 * 1024 * 1024  # 256MB
+app.config["BODY_TIMEOUT"] = 300  # 秒
+
+@dataclass(slots=True)
+class TaskState:
+    """翻译任务状态数据类"""
+    task_id: str  # 任务ID
+    created_at: datetime  # 创建时间
+    file_path: str  # 上传文件路径
+    original_filename: str  # 原始文件名
+    status: str = "pending"  # 任务状态
+    progress: int = 0  # 已翻译字幕数
+    total: int = 0  # 字幕总数
+    percentage: float = 0  # 完成百分比
+    completed_at: Optional[datetime] = None  # 完成时间
+    output_file: Optional[str] = None  # 译文文件路径
+    error: Optional[str] = None  # 错误信息
+    tokens_usage: Optional[Dict] = None  # tokens使用情况
+    future: Optional[asyncio.Task] = field(default=None, repr=False)  # 后台翻译任务
+    _json_cache: Optional[bytes] = field(default=None, init=False, repr=False)  # 已结束任务的JSON缓存
+    
+    def to_dict(self) -> Dict:
+        """获取对外公开的任务信息"""
+        return {
+            "task_id": self.task_id,
+            "status": self.status,
+            "progress": self.progress,
+            "total": self.total,
+            "created_at": self.created_at,
+            "completed_at": self.completed_at,
+            "output_file": self.output_file,
+            "error": self.error
+        }
+    
+    def to_json(self) -> bytes:
+        """获取序列化后的任务信息，已结束的任务不再变化，序列化结果会被缓存"""
+        if self._json_cache is not None:
+            return self._json_cache
+        data = orjson.dumps(self.to_dict())
+        if self.status in ("completed", "failed"):
+            self._json_cache = data
+        return data
 
 # 存储任务状态
-tasks: Dict[str, Dict] = {}
+tasks: Dict[str, TaskState] = {}
 
-# 加载环境变量
-load_dotenv()
+# 上传文件和译文文件目录，启动时创建一次
+UPLOAD_DIR = "uploads"
+OUTPUT_DIR = "output"
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# 初始化翻译模型
-llm = TranslationModel(
-    os.getenv("API_KEY"),
-    os.getenv("ENDPOINT")
-)
+# 持有后台翻译任务的引用，防止任务在执行中被垃圾回收
+background_tasks: Set[asyncio.Task] = set()
 
-def get_task_info(task_id: str) -> Optional[Dict]:
-    """获取任务信息"""
-    if task_id not in tasks:
-        return None
-    return {
-        "task_id": task_id,
-        "status": tasks[task_id]["status"],
-        "progress": tasks[task_id]["progress"],
-        "total": tasks[task_id]["total"],
-        "created_at": tasks[task_id]["created_at"],
-        "completed_at": tasks[task_id].get("completed_at"),
-        "output_file": tasks[task_id].get("output_file"),
-        "error": tasks[task_id].get("error")
-    }
+@lru_cache(maxsize=1)
+def load_env() -> None:
+    """加载环境变量，仅在首次调用时读取.env文件"""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+@lru_cache(maxsize=1)
+def get_llm() -> "TranslationModel":
+    """获取翻译模型实例，首次调用时才导入OpenAI客户端并初始化"""
+    load_env()
+    from src.llm import TranslationModel
+    return TranslationModel(
+        os.getenv("API_KEY"),
+        os.getenv("ENDPOINT")
+    )
+
+@lru_cache(maxsize=1)
+def get_batch_size() -> int:
+    """获取批量翻译的字幕行数"""
+    load_env()
+    try:
+        return int(os.getenv("BATCH_SIZE", "8").strip())
+    except (ValueError, TypeError):
+        LOGGER.warning("BATCH_SIZE 环境变量格式无效，使用默认值: 8")
+        return 8
 
 async def process_translation(task_id: str, file_path: str, domains: Optional[list] = None):
     """处理翻译任务"""
+    state = tasks[task_id]
     try:
         # 更新任务状态
-        tasks[task_id]["status"] = "processing"
+        state.status = "processing"
+        llm = get_llm()
+        batch_size = get_batch_size()
         
         # 读取SRT文件
         subtitles = read_srt_file(file_path)
-        tasks[task_id]["total"] = len(subtitles)
+        state.total = len(subtitles)
         
-        # 准备翻译请求
-        messages = [
-            format_translation_prompt_with_context(subtitles, i)
-            for i in range(len(subtitles))
-        ]
+        # 预先提取文本和编号以避免重复索引
+        texts = [subtitle['text'] for subtitle in subtitles]
+        numbers = [subtitle['number'] for subtitle in subtitles]
         
-        # 并行发送所有请求
-        translation_tasks = [
-            llm.chat_completion(messages=[msg])
-            for msg in messages
-        ]
+        # 并行发送所有请求，并发数由翻译模型限制
+        # 每个批次在自己的协程中构建提示，第一个请求无需等待所有提示构建完成
+        batch_starts = range(0, len(subtitles), batch_size)
+        batch_results = [None] * len(batch_starts)
+        failed_batches = 0
         
-        # 使用asyncio.gather执行所有请求
-        results = []
-        usages = []
-        for i, task_coro in enumerate(translation_tasks):
-            result_tuple = await task_coro
-            # 提取翻译文本（第一个元素）
-            translation_text = result_tuple[0] if result_tuple else None
-            results.append(translation_text)
-            
-            # 提取token使用情况（第三个元素，如果存在）
-            if result_tuple and len(result_tuple) > 2:
-                usage = result_tuple[2]
-                usages.append(usage)
-                
+        async def run(batch_index: int, start_index: int):
+            nonlocal failed_batches
+            try:
+                msg = format_translation_prompt_with_context(texts, numbers, start_index, batch_size=batch_size)
+                result_tuple = await llm.chat_completion(messages=[msg])
+                # 重试次数耗尽时返回None，该批次同样计为失败
+                if result_tuple is None:
+                    LOGGER.error(f"批次 {start_index} 重试次数耗尽，将保留原文")
+                    failed_batches += 1
+                result_text = result_tuple[0] if result_tuple else None
+                # 解析批量翻译结果
+                parsed_results = parse_batch_translation_result(
+                    result_text,
+                    texts,
+                    numbers,
+                    start_index,
+                    batch_size
+                )
+                # 无法解析的结果不保留在缓存中
+                if all(result[0] is None for result in parsed_results):
+                    llm.evict_cache([msg])
+            except Exception as e:
+                # 单个批次出错不影响其他批次，该批次保留原文
+                LOGGER.error(f"批次 {start_index} 翻译失败，将保留原文: {str(e)}")
+                failed_batches += 1
+                parsed_results = [(None, None, None)] * len(texts[start_index:start_index + batch_size])
+            # 按批次编号保存结果，与完成顺序无关
+            batch_results[batch_index] = parsed_results
             # 更新进度
-            tasks[task_id].update({
-                "progress": i + 1,
-                "percentage": round((i + 1) * 100 / len(subtitles), 2)
-            })
+            state.progress += len(parsed_results)
+            state.percentage = round(state.progress * 100 / state.total, 2)
+        
+        # 使用asyncio.gather执行所有请求，任务被取消时会一并取消所有批次
+        await asyncio.gather(*(
+            run(batch_index, start_index)
+            for batch_index, start_index in enumerate(batch_starts)
+        ))
+        if batch_starts and failed_batches == len(batch_starts):
+            raise RuntimeError("所有批次均翻译失败")
+        if failed_batches:
+            LOGGER.warning(f"翻译任务 {task_id} 有 {failed_batches} 个批次翻译失败，已保留原文")
+        
+        # 按批次顺序展开翻译结果
+        results = [
+            result
+            for parsed_results in batch_results
+            for result in parsed_results
+        ]
         
         # 生成译文文件
-        output_dir = "output"
-        translated_file = generate_translated_srt(subtitles, results, output_dir, file_path)
+        translated_file = generate_translated_srt(subtitles, results, OUTPUT_DIR, file_path)
+        await llm.save_cache()
         
         # 更新任务状态
-        total_usage = llm.get_total_usage()
-        tasks[task_id].update({
-            "status": "completed",
-            "completed_at": datetime.now().isoformat(),
-            "output_file": translated_file,
-            "percentage": 100,
-            "tokens_usage": total_usage
-        })
+        state.tokens_usage = llm.get_total_usage()
+        state.output_file = translated_file
+        state.percentage = 100
+        state.completed_at = datetime.now()
+        state.status = "completed"
         
         # 清理上传的文件
         if os.path.exists(file_path):
@@ -123,14 +214,34 @@ async def process_translation(task_id: str, file_path: str, domains: Optional[li
         
     except Exception as e:
         LOGGER.error(f"翻译任务 {task_id} 执行失败: {str(e)}")
-        tasks[task_id].update({
-            "status": "failed",
-            "error": str(e),
-            "completed_at": datetime.now().isoformat()
-        })
+        state.error = str(e)
+        state.completed_at = datetime.now()
+        state.status = "failed"
+        # 清理文件
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    
+    except asyncio.CancelledError:
+        LOGGER.info(f"翻译任务 {task_id} 已取消")
         # 清理文件
         if os.path.exists(file_path):
             os.remove(file_path)
+        raise
+
+@app.after_serving
+async def close_llm():
+    """服务关闭时释放翻译模型的连接池"""
+    if get_llm.cache_info().currsize:
+        await get_llm().close()
+
+def ojsonify(obj) -> Response:
+    """使用orjson序列化并构建JSON响应"""
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
+def save_upload(stream, file_path: str) -> None:
+    """以1MiB为单位将上传文件写入磁盘，减少写入系统调用次数"""
+    with open(file_path, 'wb', buffering=0) as out:
+        shutil.copyfileobj(stream, out, length=1 << 20)
 
 def validate_srt_file(file) -> bool:
     """验证SRT文件"""
@@ -155,41 +266,40 @@ async def start_translation():
     - task_id: 任务ID
     """
     try:
-        if 'file' not in request.files:
-            return jsonify({"error": "没有上传文件"}), 400
+        files = await request.files
+        if 'file' not in files:
+            return ojsonify({"error": "没有上传文件"}), 400
             
-        file = request.files['file']
+        file = files['file']
         if not validate_srt_file(file):
-            return jsonify({"error": "无效的SRT文件"}), 400
+            return ojsonify({"error": "无效的SRT文件"}), 400
         
         # 保存上传的文件
-        upload_dir = "uploads"
-        os.makedirs(upload_dir, exist_ok=True)
-            
-        file_path = os.path.join(upload_dir, f"{uuid.uuid4()}.srt")
-        file.save(file_path)
+        file_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}.srt")
+        await asyncio.to_thread(save_upload, file.stream, file_path)
         
         # 获取专业领域参数
-        domains = request.form.get('domains', '').split(',') if request.form.get('domains') else None
+        form = await request.form
+        domains = form.get('domains', '').split(',') if form.get('domains') else None
         
         # 创建任务ID
         task_id = str(uuid.uuid4())
         
         # 初始化任务状态
-        tasks[task_id] = {
-            "status": "pending",
-            "progress": 0,
-            "total": 0,
-            "percentage": 0,
-            "created_at": datetime.now().isoformat(),
-            "file_path": file_path,
-            "original_filename": file.filename
-        }
+        tasks[task_id] = TaskState(
+            task_id=task_id,
+            created_at=datetime.now(),
+            file_path=file_path,
+            original_filename=file.filename
+        )
         
-        # 启动异步任务
-        asyncio.create_task(process_translation(task_id, file_path, domains))
+        # 启动后台任务，并保留引用直到任务结束
+        future = asyncio.create_task(process_translation(task_id, file_path, domains))
+        background_tasks.add(future)
+        future.add_done_callback(background_tasks.discard)
+        tasks[task_id].future = future
         
-        return jsonify({
+        return ojsonify({
             "task_id": task_id,
             "message": "翻译任务已提交",
             "status_url": f"/api/tasks/{task_id}"
@@ -197,46 +307,46 @@ async def start_translation():
         
     except Exception as e:
         LOGGER.error(f"提交翻译任务失败: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}), 500
 
 @app.route('/api/tasks/<task_id>', methods=['GET'])
-def get_task_status(task_id):
+async def get_task_status(task_id):
     """获取任务状态"""
-    task_info = get_task_info(task_id)
-    if task_info is None:
-        return jsonify({"error": "任务不存在"}), 404
-    return jsonify(task_info)
+    state = tasks.get(task_id)
+    if state is None:
+        return ojsonify({"error": "任务不存在"}), 404
+    return Response(state.to_json(), mimetype='application/json')
 
 @app.route('/api/tasks', methods=['GET'])
-def list_tasks():
+async def list_tasks():
     """获取所有任务列表"""
-    return jsonify([
-        get_task_info(task_id)
-        for task_id in tasks
-    ])
+    # 直接拼接各任务的JSON，避免逐个任务重新序列化
+    body = b'[' + b','.join(state.to_json() for state in list(tasks.values())) + b']'
+    return Response(body, mimetype='application/json')
 
 @app.route('/api/tasks/<task_id>', methods=['DELETE'])
-def delete_task(task_id):
-    """删除任务记录"""
-    if task_id not in tasks:
-        return jsonify({"error": "任务不存在"}), 404
+async def delete_task(task_id):
+    """删除任务记录，未完成的任务会被取消"""
+    state = tasks.get(task_id)
+    if state is None:
+        return ojsonify({"error": "任务不存在"}), 404
         
-    # 如果任务正在进行中，不允许删除
-    if tasks[task_id]["status"] == "processing":
-        return jsonify({"error": "无法删除正在进行的任务"}), 400
+    # 取消尚未完成的翻译任务
+    if state.future is not None and not state.future.done():
+        state.future.cancel()
+        LOGGER.info(f"取消翻译任务: {task_id}")
         
     # 清理输出文件
-    output_file = tasks[task_id].get("output_file")
+    output_file = state.output_file
     if output_file and os.path.exists(output_file):
         os.remove(output_file)
         
     # 删除任务记录
     del tasks[task_id]
-    return jsonify({"message": "任务已删除"})
+    return ojsonify({"message": "任务已删除"})
 
 if __name__ == '__main__':
-    # 确保必要的目录存在
-    os.makedirs("uploads", exist_ok=True)
-    os.makedirs("output", exist_ok=True)
-    
-    app.run(host='0.0.0.0', port=5000) 
\ No newline at end of file
+    # 使用ASGI服务器运行，已安装uvloop/httptools时会自动启用
+    # 任务状态保存在进程内存中，因此只能使用单个worker
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000, loop="auto", http="auto") 
\ No newline at end of file
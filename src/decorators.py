@@ -16,34 +16,103 @@ License: MIT
 Version: 1.0.0
 """
 
+import asyncio
+import random
 import time
 from functools import wraps
 from typing import Callable, Optional, Any
 from src.logging import LOGGER
 
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    从异常携带的HTTP响应中读取Retry-After头
+    
+    Args:
+        error: 捕获到的异常
+    
+    Returns:
+        服务端要求的等待秒数，不存在或无法解析时返回None
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def get_backoff_delay(attempt: int, delay: float, backoff_factor: float) -> float:
+    """
+    计算第 attempt 次失败后的等待时间
+    
+    在指数退避的基础上乘以 0.5~1.5 的随机系数，避免并发请求同时重试
+    
+    Args:
+        attempt: 已失败的次数（从0开始）
+        delay: 初始延迟时间（秒）
+        backoff_factor: 重试延迟时间的增长因子
+    
+    Returns:
+        等待秒数
+    """
+    return delay * (backoff_factor ** attempt) * random.uniform(0.5, 1.5)
+
 def retry_on_failure(
     max_retries: int = 3,
     delay: float = 1.0,
     backoff_factor: float = 2.0,
-    exceptions: tuple = (Exception,)
+    exceptions: tuple = (Exception,),
+    fatal_exceptions: tuple = ()
 ) -> Callable:
     """
     重试装饰器，用于处理LLM API调用失败的情况
     
+    同时支持普通函数和协程函数。协程函数使用 asyncio.sleep 等待，
+    等待时间附加随机抖动，并优先使用服务端返回的 Retry-After 时间。
+    
     Args:
         max_retries: 最大重试次数
         delay: 初始延迟时间（秒）
         backoff_factor: 重试延迟时间的增长因子
         exceptions: 需要重试的异常类型
+        fatal_exceptions: 不可重试的异常类型（如请求错误、认证失败），直接抛出
     
     Returns:
         装饰器函数
     """
     def decorator(func: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs) -> Optional[Any]:
+                for attempt in range(max_retries + 1):
+                    try:
+                        result = await func(*args, **kwargs)
+                        if result is None:  # 如果返回None也视为失败
+                            raise ValueError("API返回为空")
+                        return result
+                        
+                    except fatal_exceptions as e:
+                        LOGGER.error(f"函数 {func.__name__} 调用失败且不可重试: {str(e)}")
+                        raise
+                    except exceptions as e:
+                        if attempt == max_retries:
+                            LOGGER.error(f"函数 {func.__name__} 已达到最大重试次数 {max_retries}，最后一次错误: {str(e)}")
+                            return None
+                        
+                        # 优先遵循服务端的Retry-After，否则使用带随机抖动的指数退避
+                        wait_time = get_retry_after(e)
+                        if wait_time is None:
+                            wait_time = get_backoff_delay(attempt, delay, backoff_factor)
+                        LOGGER.warning(f"函数 {func.__name__} 第 {attempt + 1} 次调用失败: {str(e)}")
+                        LOGGER.info(f"等待 {wait_time:.2f} 秒后重试...")
+                        await asyncio.sleep(wait_time)
+                
+                return None
+            return async_wrapper
+        
         @wraps(func)
         def wrapper(*args, **kwargs) -> Optional[Any]:
-            current_delay = delay
-            
             for attempt in range(max_retries + 1):
                 try:
                     result = func(*args, **kwargs)
@@ -51,15 +120,18 @@ def retry_on_failure(
                         raise ValueError("API返回为空")
                     return result
                     
+                except fatal_exceptions as e:
+                    LOGGER.error(f"函数 {func.__name__} 调用失败且不可重试: {str(e)}")
+                    raise
                 except exceptions as e:
                     if attempt == max_retries:
                         LOGGER.error(f"函数 {func.__name__} 已达到最大重试次数 {max_retries}，最后一次错误: {str(e)}")
                         return None
                     
+                    wait_time = get_backoff_delay(attempt, delay, backoff_factor)
                     LOGGER.warning(f"函数 {func.__name__} 第 {attempt + 1} 次调用失败: {str(e)}")
-                    LOGGER.info(f"等待 {current_delay:.2f} 秒后重试...")
-                    time.sleep(current_delay)
-                    current_delay *= backoff_factor
+                    LOGGER.info(f"等待 {wait_time:.2f} 秒后重试...")
+                    time.sleep(wait_time)
             
             return None
         return wrapper
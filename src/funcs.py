@@ -17,9 +17,20 @@ Version: 1.0.0
 """
 
 import os
-from typing import List, Dict
+import re
+import orjson
+from typing import List, Dict, Optional, Tuple
 from src.logging import LOGGER
 
+# 匹配单个字幕块：序号行、时间戳行以及随后的一行或多行非空文本
+SRT_BLOCK_RE = re.compile(
+    r'^\s*(\d+)[ \t]*\n([^\n]+)\n((?:[ \t]*\S[^\n]*(?:\n|\Z))+)',
+    re.MULTILINE
+)
+
+# 匹配LLM返回结果中的JSON数组
+JSON_ARRAY_RE = re.compile(rb'\[.*\]', re.DOTALL)
+
 def read_srt_file(file_path: str) -> List[Dict]:
     """
     读取SRT文件并解析内容
@@ -39,30 +50,23 @@ def read_srt_file(file_path: str) -> List[Dict]:
         with open(file_path, 'r', encoding='utf-8-sig') as f:  # 使用 utf-8-sig 来自动处理 BOM
             content = f.read().strip()
             
-        # 按空行分割字幕块
-        subtitle_blocks = content.split('\n\n')
+        # 单次扫描解析所有字幕块，两次匹配之间的非空内容即为无法解析的字幕块
         subtitles = []
-        
-        for block in subtitle_blocks:
-            lines = block.strip().split('\n')
-            if len(lines) < 3:
-                LOGGER.warning(f"跳过无效字幕块: {block}")
-                continue
-                
-            try:
-                # 解析字幕块
-                subtitle_number = int(lines[0])  # 现在不会包含BOM了
-                timestamp = lines[1]
-                text = ' '.join(lines[2:])  # 合并可能的多行文本
-                
-                subtitles.append({
-                    'number': subtitle_number,
-                    'timestamp': timestamp,
-                    'text': text
-                })
-            except ValueError as e:
-                LOGGER.error(f"解析字幕块时出错: {str(e)}, 块内容: {block}")
-                continue
+        last_end = 0
+        for match in SRT_BLOCK_RE.finditer(content):
+            skipped = content[last_end:match.start()].strip()
+            if skipped:
+                LOGGER.warning(f"跳过无效字幕块: {skipped}")
+            last_end = match.end()
+            subtitle_number, timestamp, text = match.groups()
+            subtitles.append({
+                'number': int(subtitle_number),
+                'timestamp': timestamp.strip(),
+                'text': text.strip().replace('\n', ' ')  # 合并可能的多行文本
+            })
+        skipped = content[last_end:].strip()
+        if skipped:
+            LOGGER.warning(f"跳过无效字幕块: {skipped}")
             
         LOGGER.info(f"成功读取字幕文件，共 {len(subtitles)} 条字幕")
         return subtitles
@@ -88,106 +92,174 @@ def display_translation_results(subtitles: List[Dict], results: List[tuple]) ->
         else:
             LOGGER.warning(f"字幕 #{subtitle['number']} 翻译失败")
 
-def format_translation_prompt_with_context(subtitles: List[Dict], start_index: int, batch_size: int = 3) -> Dict:
+def split_batches(texts: List[str], max_batch_size: int, max_batch_tokens: Optional[int] = None) -> List[Tuple[int, int]]:
+    """
+    将字幕划分为批次
+    
+    每个批次最多包含 max_batch_size 条字幕；指定 max_batch_tokens 时，
+    同时按估算的tokens数量装箱，使较短的对白行能合并到更少的请求中
+    
+    Args:
+        texts: 所有字幕的文本列表
+        max_batch_size: 每批次最多字幕条数
+        max_batch_tokens: 每批次最多估算tokens数（可选）
+        
+    Returns:
+        (批次起始索引, 批次大小) 列表
+    """
+    batches = []
+    start_index = 0
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        # 粗略估算：英文约4个字符对应1个token
+        tokens = len(text) // 4 + 1
+        size = i - start_index
+        if size and (size >= max_batch_size or (max_batch_tokens and batch_tokens + tokens > max_batch_tokens)):
+            batches.append((start_index, size))
+            start_index = i
+            batch_tokens = 0
+        batch_tokens += tokens
+    if start_index < len(texts):
+        batches.append((start_index, len(texts) - start_index))
+    return batches
+
+def format_translation_prompt_with_context(texts: List[str], numbers: List[int], start_index: int, batch_size: int = 3) -> Dict:
     """
     格式化带上下文的批量翻译提示
     
     Args:
-        subtitles: 所有字幕列表
+        texts: 所有字幕的文本列表
+        numbers: 所有字幕的编号列表
         start_index: 批次起始索引
         batch_size: 批次大小，默认3行
         
     Returns:
         格式化的消息字典
     """
-    end_index = min(start_index + batch_size, len(subtitles))
-    
-    # 获取上文（最多两句）
-    context_before = []
-    for i in range(max(0, start_index - 2), start_index):
-        context_before.append(subtitles[i]['text'])
+    end_index = min(start_index + batch_size, len(texts))
     
-    # 获取下文（最多两句）
-    context_after = []
-    for i in range(end_index, min(len(subtitles), end_index + 2)):
-        context_after.append(subtitles[i]['text'])
+    # 获取上文和下文（各最多两句）
+    context_before = " - ".join(texts[max(0, start_index - 2):start_index])
+    context_after = " - ".join(texts[end_index:end_index + 2])
     
     # 获取当前批次的字幕
-    current_batch = []
-    for i in range(start_index, end_index):
-        current_batch.append({
-            "编号": subtitles[i]['number'],
-            "文本": subtitles[i]['text']
-        })
+    current_batch = [
+        {"编号": number, "文本": text}
+        for number, text in zip(numbers[start_index:end_index], texts[start_index:end_index])
+    ]
     
     # 构建上下文字典
     context = {
-        "上文": " - ".join(context_before) if context_before else "",
+        "上文": context_before,
         "当前批次": current_batch,
-        "下文": " - ".join(context_after) if context_after else ""
+        "下文": context_after
     }
     
     return {
         "role": "user",
-        "content": (
-            str(context)
-        )
+        "content": orjson.dumps(context).decode('utf-8')
     }
 
-def parse_batch_translation_result(result: str, subtitles: List[Dict], start_index: int, batch_size: int = 3) -> List[tuple]:
+def parse_batch_translation_result(result: str, texts: List[str], numbers: List[int], start_index: int, batch_size: int = 3) -> List[tuple]:
     """
     解析批量翻译结果
     
     Args:
         result: LLM返回的翻译结果文本
-        subtitles: 原字幕列表
+        texts: 所有字幕的文本列表
+        numbers: 所有字幕的编号列表
         start_index: 批次起始索引
         batch_size: 批次大小
         
     Returns:
         解析后的翻译结果列表，与原始format兼容
     """
-    import json
-    import re
+    end_index = min(start_index + batch_size, len(texts))
     
     # 尝试从结果中提取JSON格式的翻译数据
     try:
         # 使用正则表达式查找JSON数组
-        json_match = re.search(r'\[.*\]', result, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(0)
-            translations = json.loads(json_str)
-            
-            # 构建与单行翻译结果格式兼容的结果
-            parsed_results = []
-            end_index = min(start_index + batch_size, len(subtitles))
-            
-            # 创建一个编号到翻译的映射
-            translation_map = {item["编号"]: item["译文"] for item in translations}
-            
-            for i in range(start_index, end_index):
-                subtitle = subtitles[i]
-                number = subtitle['number']
-                
-                if number in translation_map:
-                    # 返回 (翻译文本, 推理过程, None)，与chat_completion返回格式兼容
-                    parsed_results.append((translation_map[number], None, None))
-                else:
-                    LOGGER.warning(f"字幕 #{number} 在批量翻译结果中未找到，将使用原文")
-                    parsed_results.append((subtitle['text'], None, None))
-                    
-            return parsed_results
-            
-        else:
+        json_match = JSON_ARRAY_RE.search(result.encode('utf-8')) if result else None
+        if not json_match:
             raise ValueError("无法在结果中找到JSON格式的翻译数据")
+        translations = orjson.loads(json_match.group(0))
     
-    except Exception as e:
+    except ValueError as e:
         LOGGER.error(f"解析批量翻译结果时出错: {str(e)}")
         LOGGER.error(f"原始结果: {result}")
         
         # 返回空结果，保持与原始字幕数量一致
-        end_index = min(start_index + batch_size, len(subtitles))
         return [(None, None, None) for _ in range(start_index, end_index)]
+    
+    # 创建一个编号到翻译的映射，跳过格式不正确或译文不是字符串的条目
+    translation_map = {}
+    for item in translations:
+        try:
+            translation = item["译文"]
+            if isinstance(translation, str):
+                translation_map[item["编号"]] = translation
+        except (KeyError, TypeError):
+            continue
+    
+    batch_numbers = numbers[start_index:end_index]
+    # 没有任何一条字幕得到翻译时视为解析失败，交由调用方移除缓存并拆分重试
+    if not any(number in translation_map for number in batch_numbers):
+        LOGGER.error("解析批量翻译结果时出错: 结果中没有本批次字幕的有效译文")
+        LOGGER.error(f"原始结果: {result}")
+        return [(None, None, None) for _ in range(start_index, end_index)]
+    
+    # 构建与单行翻译结果格式兼容的结果
+    parsed_results = []
+    for number, text in zip(batch_numbers, texts[start_index:end_index]):
+        if number in translation_map:
+            # 返回 (翻译文本, 推理过程, None)，与chat_completion返回格式兼容
+            parsed_results.append((translation_map[number], None, None))
+        else:
+            LOGGER.warning(f"字幕 #{number} 在批量翻译结果中未找到，将使用原文")
+            parsed_results.append((text, None, None))
+            
+    return parsed_results
+
+def get_translated_srt_path(output_dir: str, original_filename: str) -> str:
+    """
+    获取译文SRT文件路径，并确保输出目录存在
+    
+    Args:
+        output_dir: 输出目录
+        original_filename: 原始文件名
+        
+    Returns:
+        译文文件路径
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(original_filename))[0]
+    return os.path.join(output_dir, f"{base_name}_zh.srt")
+
+def format_srt_block(subtitle: Dict, translation_data) -> str:
+    """
+    将单条字幕及其翻译结果格式化为SRT字幕块
+    
+    Args:
+        subtitle: 原字幕
+        translation_data: 翻译结果 (可能为2元组、3元组或字符串)
+        
+    Returns:
+        SRT格式的字幕块，没有翻译结果时保持原文
+    """
+    # 适应旧版返回值 (text, reasoning) 和新版返回值 (text, reasoning, usage)
+    if isinstance(translation_data, tuple):
+        if len(translation_data) >= 1:
+            translation = translation_data[0]
+        else:
+            translation = None
+    else:
+        translation = translation_data
+    
+    if not translation:
+        LOGGER.warning(f"字幕 #{subtitle['number']} 没有翻译结果，将保持原文")
+        translation = subtitle['text']
+    
+    return f"{subtitle['number']}\n{subtitle['timestamp']}\n{translation}\n\n"
 
 def generate_translated_srt(subtitles: List[Dict], translations: List[tuple], output_dir: str, original_filename: str) -> str:
     """
@@ -202,36 +274,18 @@ def generate_translated_srt(subtitles: List[Dict], translations: List[tuple], ou
     Returns:
         生成的文件路径
     """
-    # 创建输出目录
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        LOGGER.info(f"创建输出目录: {output_dir}")
-    
-    # 生成输出文件名
-    base_name = os.path.splitext(os.path.basename(original_filename))[0]
-    output_file = os.path.join(output_dir, f"{base_name}_zh.srt")
+    # 创建输出目录并生成输出文件名
+    output_file = get_translated_srt_path(output_dir, original_filename)
     
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for subtitle, translation_data in zip(subtitles, translations):
-                # 适应旧版返回值 (text, reasoning) 和新版返回值 (text, reasoning, usage)
-                if isinstance(translation_data, tuple):
-                    if len(translation_data) >= 1:
-                        translation = translation_data[0]
-                    else:
-                        translation = None
-                else:
-                    translation = translation_data
-                
-                if not translation:
-                    LOGGER.warning(f"字幕 #{subtitle['number']} 没有翻译结果，将保持原文")
-                    translation = subtitle['text']
-                
-                # 写入SRT格式
-                f.write(f"{subtitle['number']}\n")
-                f.write(f"{subtitle['timestamp']}\n")
-                f.write(f"{translation}\n")
-                f.write("\n")
+        # 先在内存中拼接所有字幕块，再一次性写入文件
+        parts = [
+            format_srt_block(subtitle, translation_data)
+            for subtitle, translation_data in zip(subtitles, translations)
+        ]
+            
+        with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            f.writelines(parts)
                 
         LOGGER.info(f"成功生成译文字幕文件: {output_file}")
         return output_file
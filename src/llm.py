@@ -16,25 +16,32 @@ License: MIT
 Version: 1.0.0
 """
 
-from openai import AsyncOpenAI
-from typing import Optional, List, Dict
+from openai import (
+    AsyncOpenAI,
+    NOT_GIVEN,
+    RateLimitError,
+    BadRequestError,
+    AuthenticationError,
+    PermissionDeniedError,
+    NotFoundError
+)
+from typing import Optional, List, Dict, Tuple
 from src.logging import LOGGER
 from src.decorators import retry_on_failure
-from openai.types.chat import ChatCompletionMessage
-from src.tasks import TaskManager
+from functools import lru_cache
+from collections import OrderedDict
+import asyncio
+import hashlib
+import httpx
+import json
 import os
+import tempfile
 
-def generate_system_prompt(domains: Optional[List[str]] = None) -> str:
-    """
-    生成系统提示
-    
-    Args:
-        domains: 专业领域列表
-        
-    Returns:
-        格式化的系统提示
-    """
-    base_prompt = """你是一位专业的视频字幕翻译专家。你的任务是将英文字幕翻译成中文，需要注意以下几点：
+# 未设置MAX_OUTPUT_TOKENS时估算批次大小使用的输出上限（deepseek-chat的默认值）
+DEFAULT_OUTPUT_TOKENS = 4096
+
+# 系统提示的固定部分
+BASE_PROMPT = """你是一位专业的视频字幕翻译专家。你的任务是将英文字幕翻译成中文，需要注意以下几点：
 
 1. 你将收到包含上下文的字幕内容，格式为：
    {
@@ -56,22 +63,126 @@ def generate_system_prompt(domains: Optional[List[str]] = None) -> str:
    - 对于专有名词保持一致性
    - 对于人称代词，根据上下文补充明确的主语"""
 
-    if domains:
-        domain_prompt = "\n\n3. 专业领域要求：\n"
-        domain_prompt += "这是一个涉及以下领域的内容：" + "、".join(domains) + "\n"
-        domain_prompt += "请确保：\n"
-        domain_prompt += "- 使用这些领域的专业术语和行业用语\n"
-        domain_prompt += "- 保持专业术语的准确性和一致性\n"
-        domain_prompt += "- 符合相关领域的表达习惯"
-        base_prompt += domain_prompt
-    
-    output_format = """\n\n输出要求：
+OUTPUT_FORMAT_PROMPT = """\n\n输出要求：
 - 不要包含任何解释或其他内容
 - 不要翻译上下文内容
 
 记住：保持翻译的自然流畅，同时确保与上下文的连贯性。"""
 
-    return base_prompt + output_format
+@lru_cache(maxsize=32)
+def generate_system_prompt(domains: Optional[Tuple[str, ...]] = None) -> str:
+    """
+    生成系统提示，相同领域组合的结果会被缓存
+    
+    Args:
+        domains: 专业领域元组
+        
+    Returns:
+        格式化的系统提示
+    """
+    if not domains:
+        return BASE_PROMPT + OUTPUT_FORMAT_PROMPT
+    
+    domain_prompt = "\n\n3. 专业领域要求：\n"
+    domain_prompt += "这是一个涉及以下领域的内容：" + "、".join(domains) + "\n"
+    domain_prompt += "请确保：\n"
+    domain_prompt += "- 使用这些领域的专业术语和行业用语\n"
+    domain_prompt += "- 保持专业术语的准确性和一致性\n"
+    domain_prompt += "- 符合相关领域的表达习惯"
+    return BASE_PROMPT + domain_prompt + OUTPUT_FORMAT_PROMPT
+
+def get_cache_hit_tokens(usage) -> int:
+    """
+    获取命中提示缓存的输入tokens数量
+    
+    DeepSeek 通过 prompt_cache_hit_tokens 返回，OpenAI 通过
+    prompt_tokens_details.cached_tokens 返回
+    
+    Args:
+        usage: API返回的tokens使用情况
+        
+    Returns:
+        命中缓存的tokens数量，不支持时返回0
+    """
+    cache_hit_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+    if cache_hit_tokens is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cache_hit_tokens = getattr(details, "cached_tokens", None)
+    return cache_hit_tokens or 0
+
+class AdaptiveLimiter:
+    """
+    自适应并发限制器 (AIMD)
+    
+    遇到限流(429)时将可用并发数减半，连续成功若干次后再逐个恢复，
+    避免所有并发请求同时重试造成限流风暴
+    """
+    
+    def __init__(self, max_permits: int, increase_after: int = 10):
+        """
+        初始化并发限制器
+        
+        Args:
+            max_permits: 最大并发数
+            increase_after: 连续成功多少次后恢复一个并发
+        """
+        self.max_permits = max_permits
+        self.current_permits = max_permits
+        self.increase_after = increase_after
+        self._semaphore = asyncio.BoundedSemaphore(max_permits)
+        self._lock = asyncio.Lock()
+        self._successes = 0
+        # 缩减并发时尚未收回的许可数，由之后结束的请求抵扣
+        self._owed_permits = 0
+    
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._owed_permits > 0:
+            # 不归还许可，以此收回缩减的并发
+            self._owed_permits -= 1
+        else:
+            self._semaphore.release()
+    
+    async def decrease(self, seen_permits: int) -> None:
+        """
+        遇到限流时减半并发数
+        
+        Args:
+            seen_permits: 请求发出前的并发数，期间已经缩减过则不再重复缩减
+        """
+        async with self._lock:
+            self._successes = 0
+            if self.current_permits < seen_permits or self.current_permits <= 1:
+                return
+            target = max(1, self.current_permits // 2)
+            reduce = self.current_permits - target
+            self.current_permits = target
+            # 先收回空闲的许可（不会等待），其余许可不在持锁时等待，
+            # 只记录欠数，由之后结束的请求抵扣
+            while reduce and not self._semaphore.locked():
+                await self._semaphore.acquire()
+                reduce -= 1
+            self._owed_permits += reduce
+            LOGGER.warning(f"触发限流，并发数降至: {self.current_permits}")
+    
+    async def increase(self) -> None:
+        """记录一次成功请求，连续成功足够次数后恢复一个并发"""
+        async with self._lock:
+            if self.current_permits >= self.max_permits:
+                return
+            self._successes += 1
+            if self._successes >= self.increase_after:
+                self._successes = 0
+                self.current_permits += 1
+                # 优先抵消尚未收回的许可，没有欠数时才归还一个许可
+                if self._owed_permits > 0:
+                    self._owed_permits -= 1
+                else:
+                    self._semaphore.release()
+                LOGGER.debug(f"并发数恢复至: {self.current_permits}")
 
 class TranslationModel:
     def __init__(self, _api_key: str, _endpoint: str, domains: Optional[List[str]] = None):
@@ -83,14 +194,26 @@ class TranslationModel:
             _endpoint: API端点URL
             domains: 专业领域列表
         """
-        self.client = AsyncOpenAI(api_key=_api_key, base_url=_endpoint, timeout=300)
-        
         # 从环境变量读取配置，添加错误处理
         try:
             max_workers = int(os.getenv("MAX_WORKERS", "15").strip())
         except (ValueError, TypeError):
             LOGGER.warning("MAX_WORKERS 环境变量格式无效，使用默认值: 15")
             max_workers = 15
+        
+        # 连接池大小与最大并行数一致，并启用HTTP/2让并发请求复用同一连接
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_workers, max_keepalive_connections=max_workers),
+            http2=True
+        )
+        self.client = AsyncOpenAI(
+            api_key=_api_key,
+            base_url=_endpoint,
+            timeout=300,
+            # 关闭SDK内置重试，统一由retry_on_failure处理重试和Retry-After
+            max_retries=0,
+            http_client=self.http_client
+        )
             
         try:
             self.temperature = float(os.getenv("TEMPERATURE", "1.3").strip())
@@ -98,13 +221,49 @@ class TranslationModel:
             LOGGER.warning("TEMPERATURE 环境变量格式无效，使用默认值: 1.3")
             self.temperature = 1.3
         
-        self.task_manager = TaskManager(max_workers=max_workers)
-        self.system_prompt = generate_system_prompt(domains)
+        # 仅在显式设置MAX_OUTPUT_TOKENS时随请求发送max_tokens，否则使用服务端默认上限
+        self.max_output_tokens: Optional[int] = None
+        if os.getenv("MAX_OUTPUT_TOKENS"):
+            try:
+                self.max_output_tokens = int(os.getenv("MAX_OUTPUT_TOKENS").strip())
+            except (ValueError, TypeError):
+                LOGGER.warning("MAX_OUTPUT_TOKENS 环境变量格式无效，使用服务端默认值")
+        
+        self.max_workers = max_workers
+        self.limiter = AdaptiveLimiter(max_workers)
+        self.system_prompt = generate_system_prompt(tuple(domains) if domains else None)
         self.model = os.getenv("MODEL_NAME", "deepseek-chat")
         
+        # 系统消息只构建一次，保证每次请求的前缀完全一致以命中API的提示缓存
+        self._system_message = {"role": "system", "content": self.system_prompt}
+        # 支持prompt_cache_key的服务（如OpenAI）可通过该键将相同前缀的请求路由到同一缓存
+        self.extra_body = None
+        if os.getenv("USE_PROMPT_CACHE_KEY", "false").strip().lower() == "true":
+            self.extra_body = {
+                "prompt_cache_key": hashlib.sha1(self.system_prompt.encode('utf-8')).hexdigest()
+            }
+        
+        # 重跑缓存，仅在配置CACHE_FILE后启用：以整个批次请求为键持久化翻译结果，
+        # 重新翻译同一文件且批次划分相同时直接复用，并非逐行去重（提示中包含编号和上下文）；
+        # 按最近使用顺序最多保留CACHE_MAX_ENTRIES条，避免常驻进程内存无限增长
+        try:
+            self.cache_max_entries = int(os.getenv("CACHE_MAX_ENTRIES", "10000").strip())
+        except (ValueError, TypeError):
+            LOGGER.warning("CACHE_MAX_ENTRIES 环境变量格式无效，使用默认值: 10000")
+            self.cache_max_entries = 10000
+        self.cache_file = os.getenv("CACHE_FILE")
+        self.response_cache: Optional[OrderedDict] = None
+        if self.cache_file:
+            self.response_cache = self._load_cache()
+        
         # 添加tokens统计
         self.total_prompt_tokens = 0
         self.total_completion_tokens = 0
+        self.total_cache_hit_tokens = 0
+        
+        # 根据API返回的tokens使用情况动态估算批次大小
+        self._suggested_batch_size: Optional[int] = None
+        self._tokens_per_subtitle: Optional[float] = None
         
         # 记录配置信息
         LOGGER.info(f"OpenAI客户端初始化成功，API端点: {_endpoint}")
@@ -113,62 +272,208 @@ class TranslationModel:
         LOGGER.info(f"Temperature: {self.temperature}")
         if domains:
             LOGGER.info(f"设置专业领域: {', '.join(domains)}")
+        if self.cache_file:
+            LOGGER.info(f"翻译缓存文件: {self.cache_file}，已缓存 {len(self.response_cache)} 条结果")
+    
+    def _load_cache(self) -> OrderedDict:
+        """
+        从缓存文件加载翻译结果缓存
+        
+        Returns:
+            请求哈希到翻译文本的映射，超出条数上限时只保留最新的部分
+        """
+        cache = OrderedDict()
+        if not os.path.exists(self.cache_file):
+            return cache
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                cache.update(json.load(f))
+        except (OSError, ValueError) as e:
+            LOGGER.warning(f"读取翻译缓存失败，将使用空缓存: {str(e)}")
+            return OrderedDict()
+        while len(cache) > self.cache_max_entries:
+            cache.popitem(last=False)
+        return cache
+    
+    def _write_cache(self, entries: Dict[str, str]) -> None:
+        """
+        将缓存内容写入临时文件后替换缓存文件，避免写入中断导致缓存文件损坏
+        
+        Args:
+            entries: 要写入的缓存内容
+        """
+        cache_dir = os.path.dirname(self.cache_file) or "."
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_file)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    
+    async def save_cache(self) -> None:
+        """将翻译结果缓存写入缓存文件（未配置CACHE_FILE时不执行任何操作）"""
+        if self.response_cache is None:
+            return
+        # 在事件循环中复制一份快照，文件写入放到线程中执行，不阻塞其他请求
+        entries = dict(self.response_cache)
+        await asyncio.to_thread(self._write_cache, entries)
+        LOGGER.info(f"已保存 {len(entries)} 条翻译缓存至: {self.cache_file}")
+    
+    def _cache_key(self, messages: list, model: str) -> str:
+        """根据模型、系统提示和消息内容计算缓存键"""
+        payload = json.dumps([model, self.system_prompt, messages], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def evict_cache(self, messages: list, model: Optional[str] = None) -> None:
+        """
+        移除指定请求的缓存结果，用于丢弃无法解析的翻译
+        
+        Args:
+            messages: 消息列表
+            model: 模型名称（可选）
+        """
+        if self.response_cache is not None:
+            self.response_cache.pop(self._cache_key(messages, model or self.model), None)
     
-    @retry_on_failure(max_retries=5, delay=3.0, backoff_factor=2.0)
-    async def chat_completion(self, messages: list, model: Optional[str] = None) -> tuple[Optional[str], Optional[str], Optional[Dict]]:
+    # 请求参数、密钥、权限或模型名错误时重试没有意义，直接抛出
+    @retry_on_failure(
+        max_retries=5,
+        delay=3.0,
+        backoff_factor=2.0,
+        fatal_exceptions=(BadRequestError, AuthenticationError, PermissionDeniedError, NotFoundError)
+    )
+    async def chat_completion(self, messages: list, model: Optional[str] = None, batch_size: Optional[int] = None) -> tuple[Optional[str], Optional[str], Optional[Dict]]:
         """
         发送聊天请求到LLM
         
         Args:
             messages: 消息列表
             model: 模型名称（可选，如果不指定则使用环境变量中的设置）
+            batch_size: 请求包含的字幕条数（可选，指定后用于更新建议的批次大小）
             
         Returns:
             tuple: (翻译文本, 推理内容, tokens使用情况)
         """
-        async def _do_completion():
-            # 添加系统提示
-            full_messages = [
-                {"role": "system", "content": self.system_prompt}
-            ] + messages
-            LOGGER.info(f"发送请求: {full_messages[1:]}")
-            response = await self.client.chat.completions.create(
-                model=model or self.model,
-                messages=full_messages,
-                temperature=self.temperature
-            )
-            
-            message = response.choices[0].message
-            reasoning_content = None
-            if isinstance(message, ChatCompletionMessage) and hasattr(message, "reasoning_content"):
-                reasoning_content = message.reasoning_content
-                
-            result = message.content
-            LOGGER.info(f"响应: {result}")
-            # 获取tokens使用情况
+        model = model or self.model
+        
+        # 相同请求直接返回缓存结果
+        cache_key = None
+        cached = None
+        if self.response_cache is not None:
+            cache_key = self._cache_key(messages, model)
+            cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            self.response_cache.move_to_end(cache_key)
+            LOGGER.debug(f"命中翻译缓存: {cache_key}")
             usage = {
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "total_tokens": response.usage.total_tokens
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0,
+                "cache_hit_tokens": 0
             }
-            
-            return result, reasoning_content, usage
-            
-        # 提交任务到队列
-        task_id = await self.task_manager.submit(_do_completion)
-        # 等待任务完成并获取结果
-        task = await self.task_manager.get_result(task_id)
-        
-        if task and task.completed:
-            if task.error:
-                raise task.error
-            result, reasoning, usage = task.result
-            # 累加tokens
-            self.total_prompt_tokens += usage["prompt_tokens"]
-            self.total_completion_tokens += usage["completion_tokens"]
-            return result, reasoning, usage
-        return None, None, None
+            return cached, None, usage
+        
+        # 添加系统提示，系统提示必须保持不变并位于首位，以命中API的前缀缓存
+        full_messages = (self._system_message, *messages)
+        # 请求和响应内容较大，仅在DEBUG级别按需格式化
+        LOGGER.opt(lazy=True).debug("发送请求: {}", lambda: full_messages[1:])
+        # 记录请求发出前的并发数，同一轮限流只缩减一次。
+        # SDK内置重试已关闭，首次429即在重试等待前缩减并发，等待期间也不占用许可
+        seen_permits = self.limiter.current_permits
+        try:
+            async with self.limiter:
+                response = await self.client.chat.completions.create(
+                    model=model,
+                    messages=full_messages,
+                    temperature=self.temperature,
+                    max_tokens=self.max_output_tokens or NOT_GIVEN,
+                    extra_body=self.extra_body
+                )
+        except RateLimitError:
+            await self.limiter.decrease(seen_permits)
+            raise
+        await self.limiter.increase()
+        
+        message = response.choices[0].message
+        # 只有推理模型会返回reasoning_content
+        reasoning_content = getattr(message, "reasoning_content", None)
+        
+        result = message.content
+        LOGGER.opt(lazy=True).debug("响应: {}", lambda: result)
+        # 获取tokens使用情况
+        usage = {
+            "prompt_tokens": response.usage.prompt_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+            "total_tokens": response.usage.total_tokens,
+            "cache_hit_tokens": get_cache_hit_tokens(response.usage)
+        }
+        LOGGER.debug(f"提示缓存命中tokens: {usage['cache_hit_tokens']}/{usage['prompt_tokens']}")
+        
+        if batch_size:
+            # 输出达到上限被截断时缩小批次，否则按实际输出量调整
+            if response.choices[0].finish_reason == "length":
+                self.shrink_batch_size(batch_size)
+            else:
+                # 推理模型的输出tokens包含推理过程，只按译文部分估算
+                details = getattr(response.usage, "completion_tokens_details", None)
+                reasoning_tokens = getattr(details, "reasoning_tokens", None) or 0
+                self._update_batch_size(batch_size, usage["completion_tokens"] - reasoning_tokens)
+        
+        # 累加tokens
+        self.total_prompt_tokens += usage["prompt_tokens"]
+        self.total_completion_tokens += usage["completion_tokens"]
+        self.total_cache_hit_tokens += usage["cache_hit_tokens"]
+        
+        if result and cache_key is not None:
+            self.response_cache[cache_key] = result
+            self.response_cache.move_to_end(cache_key)
+            if len(self.response_cache) > self.cache_max_entries:
+                self.response_cache.popitem(last=False)
+        return result, reasoning_content, usage
+    
+    @property
+    def suggested_batch_size(self) -> Optional[int]:
+        """根据已完成请求估算的下一批次字幕条数，尚无数据时为None"""
+        return self._suggested_batch_size
     
+    def shrink_batch_size(self, batch_size: int) -> None:
+        """
+        批次结果被截断或无法解析时，将建议的批次大小减半
+        
+        Args:
+            batch_size: 出错批次的字幕条数
+        """
+        self._suggested_batch_size = max(1, batch_size // 2)
+    
+    def _update_batch_size(self, batch_size: int, completion_tokens: int) -> None:
+        """
+        根据一次请求的输出tokens数更新建议的批次大小
+        
+        目标是让每次请求的输出约占输出上限的80%，每次最多增长一倍，
+        避免估算偏差导致批次突然过大
+        
+        Args:
+            batch_size: 该请求的字幕条数
+            completion_tokens: 该请求的输出tokens数（不含推理过程）
+        """
+        tokens_per_subtitle = max(completion_tokens / batch_size, 1.0)
+        if self._tokens_per_subtitle is None:
+            self._tokens_per_subtitle = tokens_per_subtitle
+        else:
+            # 指数移动平均，平滑不同批次之间的波动
+            self._tokens_per_subtitle = 0.8 * self._tokens_per_subtitle + 0.2 * tokens_per_subtitle
+        output_tokens = self.max_output_tokens or DEFAULT_OUTPUT_TOKENS
+        target = int(output_tokens * 0.8 / self._tokens_per_subtitle)
+        self._suggested_batch_size = max(1, min(target, batch_size * 2))
+    
+    async def close(self) -> None:
+        """关闭API客户端及其连接池"""
+        await self.client.close()
+        await self.http_client.aclose()
+
     def get_total_usage(self) -> Dict:
         """
         获取总的tokens使用情况
@@ -179,6 +484,7 @@ class TranslationModel:
         return {
             "total_prompt_tokens": self.total_prompt_tokens,
             "total_completion_tokens": self.total_completion_tokens,
+            "total_cache_hit_tokens": self.total_cache_hit_tokens,
             "total_tokens": self.total_prompt_tokens + self.total_completion_tokens
         }
 
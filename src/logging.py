@@ -30,12 +30,12 @@ def setup_logger():
     2. 按日期分割日志文件
     3. 自动删除超过7天的日志
     4. 包含详细的日志格式
+    5. 所有输出均通过队列在后台线程写入，不阻塞调用方
     """
     
     # 创建logs目录
     log_dir = "logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
+    os.makedirs(log_dir, exist_ok=True)
     
     # 移除默认的处理器
     logger.remove()
@@ -53,14 +53,18 @@ def setup_logger():
         sys.stderr,
         format=log_format,
         level="INFO",
-        colorize=True
+        colorize=True,
+        enqueue=True  # 异步写入，格式化和输出在后台线程完成
     )
     
     # 添加文件输出
     logger.add(
         os.path.join(log_dir, "{time:YYYY-MM-DD}.log"),
         format=log_format,
-        level="DEBUG",
+        # 默认只记录INFO及以上的简短日志，低于该级别的记录在入队前即被过滤，
+        # 完整的请求和响应内容不会被格式化和序列化；排查问题时可设为DEBUG。
+        # 日志系统在加载.env之前初始化，FILE_LOG_LEVEL需通过系统环境变量设置
+        level=os.getenv("FILE_LOG_LEVEL", "INFO").strip().upper(),
         rotation="00:00",  # 每天零点创建新文件
         retention="7 days",  # 保留7天的日志
         compression="zip",  # 压缩旧日志
@@ -17,6 +17,7 @@ Version: 1.0.0
 """
 
 import asyncio
+from functools import partial
 from typing import Optional, Any, Callable
 from dataclasses import dataclass
 from src.logging import LOGGER
@@ -30,6 +31,7 @@ class Task:
     result: Optional[Any] = None  # 任务结果
     error: Optional[Exception] = None  # 任务错误
     completed: bool = False  # 任务是否完成
+    done: Optional[asyncio.Future] = None  # 任务完成信号，在提交时创建
 
 class TaskManager:
     def __init__(self, max_workers: int = 15):
@@ -43,30 +45,31 @@ class TaskManager:
         self.semaphore = asyncio.Semaphore(max_workers)
         self.tasks = {}
         self._task_counter = 0
-        self.loop = asyncio.get_event_loop()
         LOGGER.info(f"任务管理器初始化完成，最大并行数: {max_workers}")
         
     async def _execute_task(self, task_id: int, task: Task):
         """执行单个任务"""
         async with self.semaphore:
             LOGGER.info(f"开始执行任务 {task_id}")
-            # try:
-            if asyncio.iscoroutinefunction(task.func):
-                result = await task.func(*task.args, **task.kwargs)
-            else:
-                # 如果不是协程函数，在线程池中执行
-                result = await self.loop.run_in_executor(
-                    None, task.func, *task.args, **task.kwargs
-                )
-            task.result = result
-            task.completed = True
-            LOGGER.info(f"完成任务 {task_id}")
-            # except Exception as e:
-            #     LOGGER.error(f"任务 {task_id} 执行出错: {str(e)}")
-            #     task.error = e
-            # finally:
-            #     task.completed = True
-            #     LOGGER.info(f"完成任务 {task_id}")
+            try:
+                if asyncio.iscoroutinefunction(task.func):
+                    result = await task.func(*task.args, **task.kwargs)
+                else:
+                    # 如果不是协程函数，在当前运行的事件循环的线程池中执行
+                    loop = asyncio.get_running_loop()
+                    result = await loop.run_in_executor(
+                        None, partial(task.func, *task.args, **task.kwargs)
+                    )
+                task.result = result
+            except Exception as e:
+                LOGGER.error(f"任务 {task_id} 执行出错: {str(e)}")
+                task.error = e
+            finally:
+                task.completed = True
+                # 通知等待结果的协程
+                if not task.done.done():
+                    task.done.set_result(None)
+                LOGGER.info(f"完成任务 {task_id}")
     
     async def submit(self, func: Callable, *args, **kwargs) -> int:
         """
@@ -84,6 +87,7 @@ class TaskManager:
         self._task_counter += 1
         
         task = Task(func=func, args=args, kwargs=kwargs)
+        task.done = asyncio.get_running_loop().create_future()
         self.tasks[task_id] = task
         
         # 创建异步任务并立即执行
@@ -100,17 +104,19 @@ class TaskManager:
             timeout: 超时时间（秒）
             
         Returns:
-            Task对象或None（如果超时）
+            Task对象或None（如果超时）；成功返回后任务记录会被移除，不能再次获取
         """
         if task_id not in self.tasks:
             return None
             
         task = self.tasks[task_id]
-        start_time = self.loop.time()
         
-        while not task.completed:
-            if timeout and (self.loop.time() - start_time) > timeout:
-                return None
-            await asyncio.sleep(0.1)
-            
+        # 等待任务完成信号，shield 保证超时不会取消任务本身的完成信号
+        try:
+            await asyncio.wait_for(asyncio.shield(task.done), timeout)
+        except asyncio.TimeoutError:
+            return None
+        
+        # 结果已交给调用方，移除任务记录，避免已完成任务一直占用内存
+        self.tasks.pop(task_id, None)
         return task
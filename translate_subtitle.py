@@ -11,7 +11,7 @@
 - 结果输出
 
 使用方法：
-    python translate_subtitle.py <srt_file> [--domains domain1 domain2 ...]
+    python translate_subtitle.py <srt_file> [--domains domain1 domain2 ...] [--batch-size N] [--max-batch-size N] [--max-batch-tokens N]
 
 Author: Samueli924
 Date: 2025-03
@@ -24,14 +24,18 @@ from src.logging import LOGGER
 from src.funcs import (
     read_srt_file, 
     display_translation_results,
-    generate_translated_srt,
+    get_translated_srt_path,
+    format_srt_block,
     format_translation_prompt_with_context,
-    parse_batch_translation_result
+    parse_batch_translation_result,
+    split_batches
 )
 import os
 import asyncio
 import time
 import argparse
+import aiofiles
+from typing import Optional
 from dotenv import load_dotenv
 
 async def main():
@@ -60,8 +64,20 @@ async def main():
     parser.add_argument(
         '--batch-size',
         type=int,
-        default=3,
-        help='批量翻译的字幕行数，默认为3'
+        default=25,
+        help='初始每批次翻译的字幕行数，之后根据实际tokens用量自动调整，默认为25'
+    )
+    parser.add_argument(
+        '--max-batch-size',
+        type=int,
+        default=100,
+        help='自动调整时每批次最多的字幕行数，默认为100；设为与--batch-size相同可保持批次划分稳定，便于复用翻译缓存'
+    )
+    parser.add_argument(
+        '--max-batch-tokens',
+        type=int,
+        default=None,
+        help='每批次字幕文本的最大估算tokens数，指定后按tokens数装箱，默认不限制'
     )
     args = parser.parse_args()
     
@@ -76,43 +92,125 @@ async def main():
         domains=args.domains
     )
     
+    # 预先提取文本和编号以避免重复索引
+    texts = [subtitle['text'] for subtitle in subtitles]
+    numbers = [subtitle['number'] for subtitle in subtitles]
+    
     # 准备批量翻译请求
-    batch_size = args.batch_size
     total_subtitles = len(subtitles)
-    batch_count = (total_subtitles + batch_size - 1) // batch_size  # 向上取整，确保处理所有字幕
     
-    LOGGER.info(f"总共 {total_subtitles} 条字幕，分为 {batch_count} 个批次进行翻译，每批次 {batch_size} 条")
+    LOGGER.info(f"总共 {total_subtitles} 条字幕，初始每批次 {args.batch_size} 条，之后根据tokens用量自动调整")
     
-    # 创建批量翻译请求
-    batch_messages = []
-    for i in range(0, total_subtitles, batch_size):
+    # 出错或重试次数耗尽的批次数量
+    failed_batches = 0
+    
+    async def translate_batch(start_index: int, batch_size: int) -> list:
+        """翻译一个批次，结果无法解析时拆分为更小的批次重试"""
+        nonlocal failed_batches
         batch_message = format_translation_prompt_with_context(
-            subtitles, 
-            start_index=i, 
+            texts, 
+            numbers, 
+            start_index=start_index, 
             batch_size=batch_size
         )
-        batch_messages.append(batch_message)
-    
-    # 并行发送所有批量请求
-    start_time = time.time()
-    
-    tasks = [
-        llm.chat_completion(messages=[msg])
-        for msg in batch_messages
-    ]
-    batch_results = await asyncio.gather(*tasks)
-    
-    # 解析批量翻译结果
-    all_results = []
-    for i, (result_text, reasoning, _) in enumerate(batch_results):
-        start_index = i * batch_size
+        result_tuple = await llm.chat_completion(messages=[batch_message], batch_size=batch_size)
+        # 重试次数耗尽时返回None，该批次同样计为失败
+        if result_tuple is None:
+            LOGGER.error(f"批次 {start_index} 重试次数耗尽，将保留原文")
+            failed_batches += 1
+        result_text = result_tuple[0] if result_tuple else None
+        # 解析批量翻译结果
         parsed_results = parse_batch_translation_result(
             result_text, 
-            subtitles, 
+            texts, 
+            numbers, 
             start_index, 
             batch_size
         )
-        all_results.extend(parsed_results)
+        if all(result[0] is None for result in parsed_results):
+            # 无法解析的结果不保留在缓存中
+            llm.evict_cache([batch_message])
+            # 模型有返回但格式错误时，拆分批次重试
+            if result_text and batch_size > 1:
+                llm.shrink_batch_size(batch_size)
+                half = batch_size // 2
+                LOGGER.warning(f"批次 {start_index} 解析失败，拆分为 {half} 和 {batch_size - half} 条重试")
+                return (
+                    await translate_batch(start_index, half)
+                    + await translate_batch(start_index + half, batch_size - half)
+                )
+        return parsed_results
+    
+    # 并行发送所有批量请求
+    start_time = time.time()
+    
+    # 固定数量的工作协程依次领取批次，提示在发送前才构建，
+    # 内存占用与最大并行数相关，而不是与字幕总数相关
+    # 结果带批次编号放入队列，按完成顺序处理，由写入协程按编号重新排序
+    batches = []
+    next_start = 0
+    completed_batches = asyncio.Queue()
+    
+    def claim_batch() -> Optional[int]:
+        """领取下一个批次，批次大小取翻译模型根据已完成请求给出的建议值"""
+        nonlocal next_start
+        if next_start >= total_subtitles:
+            return None
+        batch_size = min(llm.suggested_batch_size or args.batch_size, args.max_batch_size)
+        # 指定了tokens上限时，从建议的窗口中按tokens数截取第一个批次
+        _, batch_size = split_batches(
+            texts[next_start:next_start + batch_size],
+            batch_size,
+            args.max_batch_tokens
+        )[0]
+        batches.append((next_start, batch_size))
+        next_start += batch_size
+        return len(batches) - 1
+    
+    async def worker():
+        nonlocal failed_batches
+        while (batch_index := claim_batch()) is not None:
+            start_index, batch_size = batches[batch_index]
+            try:
+                parsed_results = await translate_batch(start_index, batch_size)
+            except Exception as e:
+                # 单个批次出错不影响其他批次，该批次保留原文
+                LOGGER.error(f"批次 {start_index} 翻译失败，将保留原文: {str(e)}")
+                failed_batches += 1
+                parsed_results = [(None, None, None)] * batch_size
+            await completed_batches.put((batch_index, parsed_results))
+    
+    # 译文按批次顺序边翻译边写入文件，只缓存尚未轮到写入的批次
+    output_dir = "output"
+    translated_file = get_translated_srt_path(output_dir, args.srt_file)
+    
+    async def writer():
+        reorder_buffer = {}
+        next_index = 0
+        written = 0
+        async with aiofiles.open(translated_file, 'w', encoding='utf-8') as f:
+            while written < total_subtitles:
+                batch_index, parsed_results = await completed_batches.get()
+                reorder_buffer[batch_index] = parsed_results
+                while next_index in reorder_buffer:
+                    start_index, batch_size = batches[next_index]
+                    await f.write("".join(
+                        format_srt_block(subtitle, translation_data)
+                        for subtitle, translation_data in zip(
+                            subtitles[start_index:start_index + batch_size],
+                            reorder_buffer.pop(next_index)
+                        )
+                    ))
+                    next_index += 1
+                    written += batch_size
+    
+    await asyncio.gather(
+        writer(),
+        *(worker() for _ in range(llm.max_workers))
+    )
+    
+    await llm.save_cache()
+    await llm.close()
     
     # 等待所有结果
     end_time = time.time()
@@ -121,15 +219,15 @@ async def main():
     total_usage = llm.get_total_usage()
     
     # 显示性能统计
-    LOGGER.info(f"总共处理 {len(batch_messages)} 个批量请求，耗时: {end_time - start_time:.2f} 秒")
+    LOGGER.info(f"总共处理 {len(batches)} 个批量请求，耗时: {end_time - start_time:.2f} 秒")
     LOGGER.info(f"Tokens统计:")
     LOGGER.info(f"  - 输入tokens: {total_usage['total_prompt_tokens']}")
+    LOGGER.info(f"  - 缓存命中tokens: {total_usage['total_cache_hit_tokens']}")
     LOGGER.info(f"  - 输出tokens: {total_usage['total_completion_tokens']}")
     LOGGER.info(f"  - 总计tokens: {total_usage['total_tokens']}")
     
-    # 生成译文SRT文件
-    output_dir = "output"
-    translated_file = generate_translated_srt(subtitles, all_results, output_dir, args.srt_file)
+    if failed_batches:
+        LOGGER.warning(f"有 {failed_batches} 个批次翻译失败，已保留原文")
     LOGGER.info(f"翻译完成！译文文件已保存至: {translated_file}")
             
     # except Exception as e:
@@ -137,4 +235,10 @@ async def main():
     #     raise
 
 if __name__ == "__main__":
+    # 优先使用uvloop事件循环（Windows不支持，未安装时使用标准事件循环）
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(main())